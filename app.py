@@ -1,10 +1,16 @@
 import streamlit as st
-import pandas as pd
+import re
+import orjson
 import requests
-from io import StringIO, BytesIO
-from datetime import datetime, timedelta
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from io import BytesIO
+from collections import defaultdict
+from itertools import chain
+from operator import itemgetter
+from html import escape
+import time
+from datetime import date, datetime, timedelta
 
 # Page Config
 st.set_page_config(page_title="APU Gap Finder", page_icon="🍱", layout="wide")
@@ -16,6 +22,26 @@ HEADERS = {
     'user-agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/144.0.0.0 Safari/537.36',
 }
 DAYS_OF_WEEK = ["Mon", "Tue", "Wed", "Thu", "Fri"]
+S3_TIMETABLE_URL = "https://s3-ap-southeast-1.amazonaws.com/open-ws/weektimetable"
+S3_CACHE_TTL = 43200  # 12 hours for a successful fetch (failures are never cached); refreshes revalidate by ETag
+S3_RETRY_AFTER = 60  # seconds to serve the stale copy before retrying a failed fetch
+S3_TIMEOUT = (2, 5)  # (connect, read) seconds; a stalled read is retried rather than waited out
+SLOT_PX = 20  # Height of one 15-minute slot in the timetable grid
+PREVIEW_DPI = 100  # On-page export preview (shown at 800px wide)
+EXPORT_DPI = 150  # Downloaded PNG
+# S3 has "MON", "TUE" -> Convert to "Mon", "Tue"
+S3_DAY_MAP = {'MON': 'Mon', 'TUE': 'Tue', 'WED': 'Wed', 'THU': 'Thu', 'FRI': 'Fri'}
+# MODID class-type tokens: "-L-" / "(L)" etc.
+CLASS_TYPE_RE = re.compile(r'-(L|T|LAB)-|\((L|T|LAB)\)')
+CLASS_TYPE_MAP = {'L': 'Lecture', 'T': 'Tutorial', 'LAB': 'Lab'}
+
+# Shared HTTP session so repeat fetches reuse the pooled TCP/TLS connection
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=4,
+    max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+))
 
 # --- Helper Functions ---
 
@@ -25,96 +51,124 @@ def get_start_of_week():
     start = today - timedelta(days=today.weekday())
     return start.strftime("%Y-%m-%d")
 
-@st.cache_data(ttl=21600)  # Cache for 6 hours
-def fetch_s3_data():
-    """Fetches key APU timetable data from S3."""
-    try:
-        url = "https://s3-ap-southeast-1.amazonaws.com/open-ws/weektimetable"
-        response = requests.get(url)
-        response.raise_for_status()
-        return response.json()
-    except Exception as e:
-        st.error(f"Failed to fetch data from S3: {e}")
-        return []
-
-@st.cache_data
-def get_intakes():
-    """Extracts unique sorted intake codes from S3 data."""
-    data = fetch_s3_data()
-    if not data: return []
-    intakes = sorted(list(set(item['INTAKE'] for item in data if 'INTAKE' in item)))
-    return intakes
+@st.cache_resource
+def _last_good_s3_data():
+    """Process-wide holder for the S3 fetch state, shared by every session.
 
-@st.cache_data
-def get_groups(intake_code):
-    """Extracts unique sorted groups for a specific intake."""
-    data = fetch_s3_data()
-    if not data: return []
-    groups = sorted(list(set(item['GROUPING'] for item in data if item.get('INTAKE') == intake_code)))
-    return groups
+    Keys (all optional):
+      "snapshot"  last good (version, data); set on every 200, never cleared
+      "etag"      ETag of that snapshot, sent as If-None-Match on the next fetch
+      "error"     exception from the latest failed fetch; present only while a failure is pending
+      "retry_at"  time.monotonic() before which a pending failure is not retried
+    A successful fetch clears "error" and "retry_at", ending the failure state.
+    """
+    return {}
 
-@st.cache_data
-def get_available_weeks():
-    """Extracts available weeks from the dataset."""
-    data = fetch_s3_data()
-    if not data: return []
-    dates = set()
-    for item in data:
+@st.cache_resource(ttl=S3_CACHE_TTL)  # Shared read-only (no per-access pickling)
+def fetch_s3_data():
+    """Fetches key APU timetable data from S3 as a (version, data) snapshot.
+
+    Raises on failure, so only good payloads are ever cached; load_s3_data() handles the fallback.
+    """
+    last_good = _last_good_s3_data()
+    # Revalidate against the ETag we hold; S3 answers 304 with no body if the dump is unchanged
+    # (gzip transfer is already negotiated by requests' default Accept-Encoding)
+    conditional = {"If-None-Match": last_good["etag"]} if last_good.get("etag") else {}
+    response = SESSION.get(S3_TIMETABLE_URL, headers=conditional, timeout=S3_TIMEOUT)
+    if response.status_code == 304 and "snapshot" in last_good:
+        return last_good["snapshot"]
+    response.raise_for_status()
+    data = orjson.loads(response.content)
+    # New version per payload, so the indexes keyed on it rebuild exactly when the data changes
+    version = last_good["snapshot"][0] + 1 if "snapshot" in last_good else 1
+    last_good["snapshot"] = (version, data)
+    last_good["etag"] = response.headers.get("ETag")
+    return last_good["snapshot"]
+
+def load_s3_data():
+    """Returns the current (version, data) S3 snapshot; call once per rerun.
+
+    If the fetch fails, shows why and serves the last good copy (or an empty (0, []) snapshot).
+    While a stale copy is being served, S3 is left alone for S3_RETRY_AFTER seconds between tries.
+    """
+    last_good = _last_good_s3_data()
+    if "snapshot" not in last_good or time.monotonic() >= last_good.get("retry_at", 0):
+        try:
+            snapshot = fetch_s3_data()
+        except Exception as e:
+            last_good["error"] = e
+            last_good["retry_at"] = time.monotonic() + S3_RETRY_AFTER
+        else:
+            # Recovered (or never failed): drop the pending failure so later reruns fetch normally
+            last_good.pop("error", None)
+            last_good.pop("retry_at", None)
+            return snapshot
+    
+    error = last_good.get("error")
+    if "snapshot" in last_good:
+        st.warning(f"Could not refresh timetable from S3 ({error}). Showing the last fetched copy.")
+        return last_good["snapshot"]
+    st.error(f"Failed to fetch data from S3: {error}")
+    return 0, []
+
+@st.cache_resource(max_entries=2)  # Current snapshot + the one it replaces
+def build_indexes(data_version, _data):
+    """Builds the intake, group-per-intake and week lookups in a single pass over one S3 snapshot."""
+    intakes = set()
+    groups_by_intake = defaultdict(set)
+    mondays = set()
+    for item in _data:
+        if 'INTAKE' in item:
+            intakes.add(item['INTAKE'])
+            groups_by_intake[item['INTAKE']].add(item['GROUPING'])
         if 'TIME_FROM_ISO' in item:
-            dt = datetime.fromisoformat(item['TIME_FROM_ISO'])
-            # Get Monday of the week
-            monday = dt - timedelta(days=dt.weekday())
-            dates.add(monday.date())
+            # Only the date prefix is needed to find the Monday of the week
+            event_date = date.fromisoformat(item['TIME_FROM_ISO'][:10])
+            mondays.add(event_date - timedelta(days=event_date.weekday()))
     
-    sorted_mondays = sorted(list(dates))
-    return [d.strftime("%Y-%m-%d") for d in sorted_mondays]
+    return (
+        sorted(intakes),
+        {intake: sorted(groups) for intake, groups in groups_by_intake.items()},
+        [d.strftime("%Y-%m-%d") for d in sorted(mondays)],
+    )
+
+def get_intakes(s3):
+    """Returns unique sorted intake codes from an S3 (version, data) snapshot."""
+    return build_indexes(*s3)[0]
+
+def get_groups(s3, intake_code):
+    """Returns unique sorted groups for a specific intake."""
+    return build_indexes(*s3)[1].get(intake_code, [])
+
+def get_available_weeks(s3):
+    """Returns available weeks (Mondays) from the dataset."""
+    return build_indexes(*s3)[2]
+
+@st.cache_resource(max_entries=2)  # Current snapshot + the one it replaces
+def get_intake_search_pairs(data_version, _data):
+    """Pairs each intake code with its upper-cased form for the filter boxes."""
+    return [(intake, intake.upper()) for intake in build_indexes(data_version, _data)[0]]
+
+def filter_intakes(s3, filter_text):
+    """Returns the intakes containing filter_text, case-insensitively."""
+    needle = filter_text.upper()
+    return [intake for intake, upper in get_intake_search_pairs(*s3) if needle in upper]
 
 def parse_iso_time(iso_str):
     """Parses ISO time string to decimal hour."""
+    # Read HH:MM straight from "YYYY-MM-DDTHH:MM..." instead of building a datetime
     try:
-        dt = datetime.fromisoformat(iso_str)
-        return dt.hour + dt.minute / 60
-    except:
+        return int(iso_str[11:13]) + int(iso_str[14:16]) / 60
+    except (TypeError, ValueError):
         return None
 
-@st.cache_data
-def process_s3_schedule(intake_code, group_code, week_date_str=None):
-    """Processes S3 data for a specific intake and group."""
-    data = fetch_s3_data()
-    schedule = []
-    
-    # Filter data
-    # Filter by Intake, Group, and optionally Week
-    filtered_items = []
-    
-    week_start_dt = None
-    if week_date_str:
-        week_start_dt = datetime.strptime(week_date_str, "%Y-%m-%d").date()
-        # End of the week (Sunday)
-        week_end_dt = week_start_dt + timedelta(days=6)
-    
-    for item in data:
-        if item.get('INTAKE') != intake_code or item.get('GROUPING') != group_code:
-            continue
-            
-        if week_start_dt:
-            # Check if event falls within the week
-            try:
-                event_dt = datetime.fromisoformat(item.get('TIME_FROM_ISO')).date()
-                if not (week_start_dt <= event_dt <= week_end_dt):
-                    continue
-            except:
-                continue
-                
-        filtered_items.append(item)
-
-    for item in filtered_items:
-        # Parse Day: S3 has "MON", "TUE" -> Convert to "Mon", "Tue"
-        day_map = {
-            'MON': 'Mon', 'TUE': 'Tue', 'WED': 'Wed', 'THU': 'Thu', 'FRI': 'Fri'
-        }
+@st.cache_resource(max_entries=2)  # Current snapshot + the one it replaces
+def get_events_by_week(data_version, _data):
+    """Parses every row of an S3 snapshot once, bucketed as {(intake, group): {monday: [events]}}."""
+    events_by_week = defaultdict(lambda: defaultdict(list))
+    for item in _data:
         raw_day = item.get('DAY')
-        day = day_map.get(raw_day)
+        day = S3_DAY_MAP.get(raw_day)
         
         # Parse Time
         start = parse_iso_time(item.get('TIME_FROM_ISO'))
@@ -128,13 +182,13 @@ def process_s3_schedule(intake_code, group_code, week_date_str=None):
         location = item.get('ROOM', item.get('LOCATION', 'Unknown'))
         modid = item.get('MODID', '')
         
-        # Function to determine class type from MODID
-        class_type = "Class"
-        if "-L-" in modid or "(L)" in modid: class_type = "Lecture"
-        elif "-T-" in modid or "(T)" in modid: class_type = "Tutorial"
-        elif "-LAB-" in modid or "(LAB)" in modid: class_type = "Lab"
+        # Determine class type from the MODID token, e.g. "-L-" or "(LAB)"
+        match = CLASS_TYPE_RE.search(modid)
+        class_type = CLASS_TYPE_MAP[match.group(1) or match.group(2)] if match else "Class"
 
-        schedule.append({
+        event_date = date.fromisoformat(item['TIME_FROM_ISO'][:10])
+        monday = (event_date - timedelta(days=event_date.weekday())).isoformat()
+        events_by_week[(item.get('INTAKE'), item.get('GROUPING'))][monday].append({
             'day': day,
             'start': start,
             'end': end,
@@ -145,7 +199,20 @@ def process_s3_schedule(intake_code, group_code, week_date_str=None):
             'is_gap': False
         })
         
-    return schedule
+    # Plain dicts so lookups of unknown keys cannot grow the shared cache
+    return {key: dict(weeks) for key, weeks in events_by_week.items()}
+
+@st.cache_data(ttl=S3_CACHE_TTL)  # Keyed on data_version; TTL only evicts old versions
+def process_s3_schedule(data_version, _data, intake_code, group_code, week_date_str=None):
+    """Processes S3 data for a specific intake and group.
+
+    week_date_str is the Monday of the week (as listed by get_available_weeks); None returns every week.
+    """
+    weeks = get_events_by_week(data_version, _data).get((intake_code, group_code), {})
+    
+    if not week_date_str:
+        return [e for monday in sorted(weeks) for e in weeks[monday]]
+    return weeks.get(week_date_str, [])
 
 def _schedule_to_key(schedule):
     """Convert schedule list to a hashable tuple for caching."""
@@ -155,32 +222,37 @@ def _schedule_to_key(schedule):
     )
 
 @st.cache_data
-def calculate_gaps_cached(_schedule_key):
+def calculate_gaps_cached(schedule_key):
     """Calculates gaps between classes for each day (cached version)."""
     gaps = []
-    # Reconstruct minimal info needed from key
-    schedule = [{'day': e[0], 'start': e[1], 'end': e[2]} for e in _schedule_key]
+    # Only (start, end) is needed from the key, bucketed by day in a single pass
+    events_by_day = defaultdict(list)
+    for e in schedule_key:
+        events_by_day[e[0]].append((e[1], e[2]))
     
     for day in DAYS_OF_WEEK:
-        day_events = sorted([e for e in schedule if e['day'] == day], key=lambda x: x['start'])
+        if day not in events_by_day:
+            continue
+        day_events = events_by_day[day]
+        day_events.sort(key=itemgetter(0))
         
         current_time = 8.0
         
-        for event in day_events:
-            if event['start'] > current_time:
-                duration = event['start'] - current_time
+        for start, end in day_events:
+            if start > current_time:
+                duration = start - current_time
                 if duration >= 0.25:
                     gaps.append({
                         'day': day,
                         'start': current_time,
-                        'end': event['start'],
+                        'end': start,
                         'duration': duration,
                         'subject': "Gap",
                         'type': "Gap",
                         'is_gap': True,
                         'is_mutual': False
                     })
-            current_time = max(current_time, event['end'])
+            current_time = max(current_time, end)
             
     return gaps
 
@@ -188,51 +260,66 @@ def calculate_gaps(schedule):
     """Calculates gaps between classes for each day."""
     return calculate_gaps_cached(_schedule_to_key(schedule))
 
-def intersect_two_gap_lists(list1, list2):
-    """Helper: Finds intersection between two lists of gaps."""
-    intersection = []
-    for g1 in list1:
-        for g2 in list2:
-            if g1['day'] == g2['day']:
-                start = max(g1['start'], g2['start'])
-                end = min(g1['end'], g2['end'])
-                
-                if end - start >= 0.5: # Minimum 30 mins mutual
-                   intersection.append({
-                        'day': g1['day'],
-                        'start': start,
-                        'end': end,
-                        'duration': end - start,
-                        'subject': "Mutual Gap",
-                        'type': "Mutual",
-                        'is_gap': True,
-                        'is_mutual': True
-                   })
-    return intersection
-
 def find_mutual_gaps(all_gap_lists):
-    """Finds overlapping gaps across multiple schedules (N-way interaction)."""
-    if not all_gap_lists: return []
-    
-    # Start with the first person's gaps
-    current_mutual = all_gap_lists[0]
+    """Finds overlapping gaps across multiple schedules (N-way interaction).
+
+    Each person's gaps on a day never overlap, so after sorting by start a k-way sweep
+    (advance whichever current gap ends first) finds every common window in O(k * n) per day.
+    """
+    # Anyone without gaps (or no schedules at all) means nothing can be mutual
+    if not all_gap_lists or not all(all_gap_lists): return []
+    if len(all_gap_lists) == 1: return all_gap_lists[0]
     
-    # Intersect with every subsequent person
-    for next_list in all_gap_lists[1:]:
-        current_mutual = intersect_two_gap_lists(current_mutual, next_list)
-        if not current_mutual:
-            break # No intersection possible if empty
+    # Partition by day so each gap is only compared against same-day gaps
+    lists_by_day = []
+    for gaps in all_gap_lists:
+        by_day = defaultdict(list)
+        for g in gaps:
+            by_day[g['day']].append(g)
+        lists_by_day.append(by_day)
+
+    mutual = []
+    for day in DAYS_OF_WEEK:
+        if not all(day in by_day for by_day in lists_by_day):
+            continue
+        lanes = [sorted(by_day[day], key=itemgetter('start')) for by_day in lists_by_day]
+        ptrs = [0] * len(lanes)
+        
+        while all(p < len(lane) for p, lane in zip(ptrs, lanes)):
+            current = [lane[p] for p, lane in zip(ptrs, lanes)]
+            start = max(g['start'] for g in current)
+            end = min(g['end'] for g in current)
             
-    return current_mutual
-
-def generate_schedule_image(schedules_map, mutual_gaps):
-    """Generates a matplotlib figure of the compared schedules."""
+            if end - start >= 0.5: # Minimum 30 mins mutual
+               mutual.append({
+                    'day': day,
+                    'start': start,
+                    'end': end,
+                    'duration': end - start,
+                    'subject': "Mutual Gap",
+                    'type': "Mutual",
+                    'is_gap': True,
+                    'is_mutual': True
+               })
+            
+            # Advance whichever gap finishes first; it cannot overlap anything later
+            first_done = min(range(len(current)), key=lambda k: current[k]['end'])
+            ptrs[first_done] += 1
+    return mutual
+
+def generate_schedule_image(schedules_map, mutual_gaps, dpi=EXPORT_DPI):
+    """Generates a matplotlib figure of the compared schedules as a PNG buffer."""
+    # Imported here so page loads that never open the export options skip matplotlib entirely
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Rectangle
+    from matplotlib.collections import PatchCollection
     
     n_cols = len(schedules_map)
-    fig, axes = plt.subplots(1, n_cols, figsize=(5 * n_cols, 10), sharey=True)
-    if n_cols == 1: axes = [axes] # Handle single plot case
+    # Plain Figure (no pyplot state machine or GUI backend); savefig renders through Agg
+    fig = Figure(figsize=(5 * n_cols, 10))
+    axes = fig.subplots(1, n_cols, sharey=True, squeeze=False)[0]
     
-    plt.subplots_adjust(wspace=0.1)
+    fig.subplots_adjust(wspace=0.1)
     
     # Colors
     colors = {
@@ -246,6 +333,9 @@ def generate_schedule_image(schedules_map, mutual_gaps):
     
     day_map_idx = {d: i for i, d in enumerate(DAYS_OF_WEEK)}
     
+    # Schedules only hold classes; of the gap list only mutual breaks are drawn, so filter once for every panel
+    drawable_gaps = [g for g in mutual_gaps if g.get('is_mutual')]
+    
     for idx, (name, info) in enumerate(schedules_map.items()):
         ax = axes[idx]
         ax.set_title(f"{name}\n{info.get('intake','')}\n({info.get('group','')})", fontsize=10, pad=10)
@@ -259,10 +349,11 @@ def generate_schedule_image(schedules_map, mutual_gaps):
         ax.grid(axis='y', linestyle='--', alpha=0.5)
         ax.tick_params(axis='x', length=0)
         
-        # Combine events + mutual
-        events_to_draw = info['data'] + mutual_gaps
+        # Rectangles are batched into one collection per z-layer (classes below mutual breaks)
+        layers = {5: ([], [], []), 10: ([], [], [])}  # zorder -> (rects, facecolors, edgecolors)
         
-        for e in events_to_draw:
+        # Combine events + mutual (iterated in place, no concatenated copy)
+        for e in chain(info['data'], drawable_gaps):
             if e['day'] not in day_map_idx: continue
             
             x = day_map_idx[e['day']]
@@ -270,18 +361,10 @@ def generate_schedule_image(schedules_map, mutual_gaps):
             height = e['duration']
             etype = e.get('type', 'Class')
             
-            # Skip non-mutual gaps to keep it clean, or draw them lightly
-            if etype == 'Gap' and not e.get('is_mutual'):
-                continue
-                
-            rect = patches.Rectangle(
-                (x, y), 1, height, 
-                linewidth=1, 
-                edgecolor=edge_colors.get(etype, '#999'), 
-                facecolor=colors.get(etype, '#eee'),
-                zorder=10 if etype == "Mutual" else 5
-            )
-            ax.add_patch(rect)
+            rects, faces, edges = layers[10 if etype == "Mutual" else 5]
+            rects.append(Rectangle((x, y), 1, height))
+            faces.append(colors.get(etype, '#eee'))
+            edges.append(edge_colors.get(etype, '#999'))
             
             # Text
             label = "MUTUAL BREAK" if etype == "Mutual" else f"{e['subject']}\n{e['location']}"
@@ -296,61 +379,76 @@ def generate_schedule_image(schedules_map, mutual_gaps):
                     wrap=True, clip_on=True, zorder=15
                 )
 
+        for zorder, (rects, faces, edges) in layers.items():
+            if rects:
+                ax.add_collection(PatchCollection(
+                    rects, facecolors=faces, edgecolors=edges, linewidths=1, joinstyle="miter", zorder=zorder
+                ))
+
         # Draw vertical lines for days
         for x in range(1, 5):
             ax.axvline(x, color='#eee', linewidth=1)
 
     # Save to buffer
     buf = BytesIO()
-    plt.savefig(buf, format="png", bbox_inches='tight', dpi=150)
+    fig.savefig(buf, format="png", bbox_inches='tight', dpi=dpi)
     buf.seek(0)
-    plt.close(fig)
     return buf
 
 # --- CSS / UI Components ---
 
-def inject_custom_css():
-    st.markdown("""
+# Static stylesheet, shipped inside the comparison iframe (it cannot see the page's CSS)
+CUSTOM_CSS = """
     <style>
+    body { margin: 0; font-family: "Source Sans Pro", sans-serif; color: #31333f; }
+    
     /* Main Grid Container */
     .timetable-grid {
-        display: grid;
-        grid-template-columns: 60px repeat(5, 1fr); /* Time col + 5 days */
-        grid-template-rows: 40px repeat(48, 20px); /* Header + 12 hours * 4 slots * 20px fixed height */
-        column-gap: 8px; /* Gap between columns */
-        row-gap: 0px; /* No gap between rows to form continuous lines */
+        /* Time col (60px + 8px gap) + 5 day columns separated by 8px gaps */
+        --day-col-width: calc((100% - 68px - 4 * 8px) / 5);
         background-color: #fff;
         border: 1px solid #ddd;
         border-radius: 8px;
         padding-bottom: 20px;
-        max-height: 85vh;
-        overflow-y: auto;
+        /* Full height: the iframe sizes itself to the content, so a vh cap would shrink it in a loop */
         position: relative;
     }
     
     /* Headers */
-    .grid-header {
-        font-weight: bold;
-        text-align: center;
-        padding: 10px;
-        color: #444;
+    .grid-header-row {
+        display: grid;
+        grid-template-columns: 60px repeat(5, 1fr); /* Time col + 5 days */
+        column-gap: 8px;
         background: #f8f9fa;
         border-bottom: 2px solid #ddd;
         position: sticky;
         top: 0;
         z-index: 20;
     }
-    .time-col-header { grid-column: 1; grid-row: 1; }
+    .grid-header {
+        font-weight: bold;
+        text-align: center;
+        padding: 10px;
+        color: #444;
+    }
+    
+    /* Body: 12 hours * 4 slots * 20px, events are absolutely positioned inside */
+    .grid-body {
+        position: relative;
+        height: 960px;
+    }
     
-    /* Time Axis & Grid Lines */
+    /* Time Axis */
     .time-label {
-        grid-column: 1;
+        position: absolute;
+        left: 0;
+        width: 60px;
+        box-sizing: border-box;
         font-size: 0.75rem;
         color: #666;
         text-align: right;
         padding-right: 8px;
         transform: translateY(-50%);
-        align-self: start;
         font-variant-numeric: tabular-nums;
     }
     .time-label-minor {
@@ -358,19 +456,25 @@ def inject_custom_css():
         color: #aaa;
     }
     
-    /* Horizontal Grid Lines */
-    .grid-line {
-        grid-column: 2 / 8; /* Span across days */
-        border-top: 1px solid #f0f0f0;
+    /* Horizontal Grid Lines: one painted layer instead of a div per slot */
+    .grid-lines {
+        position: absolute;
+        top: 0;
+        left: 68px;
+        right: 0;
+        height: 961px;
+        background-image:
+            repeating-linear-gradient(to bottom, #e0e0e0 0, #e0e0e0 1px, transparent 1px, transparent 80px),
+            repeating-linear-gradient(to bottom, #f0f0f0 0, #f0f0f0 1px, transparent 1px, transparent 20px);
         z-index: 1;
         pointer-events: none;
     }
-    .grid-line-major {
-        border-top: 1px solid #e0e0e0;
-    }
 
     /* Event Blocks */
     .event-card {
+        position: absolute;
+        width: calc(var(--day-col-width) - 4px);
+        box-sizing: border-box;
         padding: 6px;
         border-radius: 6px;
         font-size: 0.75rem;
@@ -382,6 +486,11 @@ def inject_custom_css():
         z-index: 10;
         margin: 1px 2px; /* Slight spacing matches design */
     }
+    .day-col-0 { left: 68px; }
+    .day-col-1 { left: calc(68px + 1 * (var(--day-col-width) + 8px)); }
+    .day-col-2 { left: calc(68px + 2 * (var(--day-col-width) + 8px)); }
+    .day-col-3 { left: calc(68px + 3 * (var(--day-col-width) + 8px)); }
+    .day-col-4 { left: calc(68px + 4 * (var(--day-col-width) + 8px)); }
     .event-card:hover {
         transform: scale(1.02);
         z-index: 15;
@@ -399,12 +508,73 @@ def inject_custom_css():
     .event-meta { font-size: 0.7rem; opacity: 0.9; text-overflow: ellipsis; white-space: nowrap; overflow: hidden; }
     .break-duration { font-size: 0.8rem; font-weight: 600; text-align: center; }
 
+    /* Side-by-side comparison of every schedule's grid; wraps to a stack on narrow screens */
+    .comparison-row { display: flex; flex-wrap: wrap; gap: 16px; }
+    .comparison-col { flex: 1 1 360px; min-width: 0; }
+    .comparison-col h3 { font-size: 1.25rem; font-weight: 600; margin: 0 0 12px; }
+
     /* Custom Scrollbar */
     ::-webkit-scrollbar { width: 8px; }
     ::-webkit-scrollbar-track { background: #f1f1f1; }
     ::-webkit-scrollbar-thumb { background: #ccc; border-radius: 4px; }
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+def _build_grid_shell():
+    """Builds the invariant grid markup: opening divs, day headers, grid-line layer and time labels."""
+    html = ['<div class="timetable-grid">', '<div class="grid-header-row">']
+    
+    # Headers
+    days = ["", "Mon", "Tue", "Wed", "Thu", "Fri"]
+    for day in days:
+        html.append(f'<div class="grid-header">{day}</div>')
+    html.append('</div>')
+        
+    start_hour = 8
+    end_hour = 20
+    slots_per_hour = 4
+    total_slots = (end_hour - start_hour) * slots_per_hour
+    
+    # Grid lines are a single background layer; only the labels need nodes
+    html.append('<div class="grid-body"><div class="grid-lines"></div>')
+    for i in range(0, total_slots + 1, 2):
+        time_val = start_hour + (i / 4)
+        hour = int(time_val)
+        minute = int((time_val % 1) * 60)
+        time_str = f"{hour:02}:{minute:02}"
+        
+        label_class = "time-label"
+        if i % 4 != 0: label_class += " time-label-minor"
+        
+        html.append(f'<div class="{label_class}" style="top: {i * SLOT_PX}px;">{time_str}</div>')
+
+    return "".join(html)
+
+# The scaffold only depends on the grid constants, so build it once at import
+GRID_SHELL_HTML = _build_grid_shell()
+GRID_SHELL_CLOSE = '</div></div>'  # .grid-body, .timetable-grid
+
+# Day column index for the .day-col-N positioning classes (Mon = 0)
+DAY_TO_COL = {d: i for i, d in enumerate(DAYS_OF_WEEK)}
+
+# Event-card markup, filled with %-formatting per event (type, column, top px, height px)
+EVENT_CARD_TPL = '<div class="event-card event-%s day-col-%d" style="top: %dpx; height: %dpx;">%s</div>'
+GAP_CONTENT_TPL = '<div class="break-duration">%s Gap</div>'
+MUTUAL_CONTENT_TPL = '<div class="break-duration">⚡ MUTUAL: %s</div>'
+CLASS_CONTENT_TPL = """
+<div class="event-title">%s</div>
+<div class="event-meta">%s</div>
+<div class="event-meta">%s</div>"""
+
+# "Hh Mm" labels for every quarter-hour duration that fits on the 08:00-20:00 grid
+DURATION_LABELS = {q: f"{q // 4}h {(q % 4) * 15}m" for q in range(49)}
+
+def format_duration(hours):
+    """Formats a decimal-hour duration as "Hh Mm", using the precomputed quarter-hour labels."""
+    label = DURATION_LABELS.get(hours * 4)
+    if label is None:
+        label = f"{int(hours)}h {int((hours % 1) * 60)}m"
+    return label
 
 def _events_to_key(events):
     """Convert events list to a hashable tuple for caching."""
@@ -415,84 +585,91 @@ def _events_to_key(events):
     )
 
 @st.cache_data
-def render_grid_html_cached(_events_key):
-    """Cached version of grid HTML generation."""
+def render_events_html_cached(events_key):
+    """Cached version of event-card HTML generation."""
     # Reconstruct events from key
     events = [
         {'day': e[0], 'start': e[1], 'end': e[2], 'duration': e[3], 'subject': e[4],
          'type': e[5], 'location': e[6], 'is_gap': e[7], 'is_mutual': e[8]}
-        for e in _events_key
+        for e in events_key
     ]
     
-    html = ['<div class="timetable-grid">']
-    
-    # Headers
-    days = ["", "Mon", "Tue", "Wed", "Thu", "Fri"]
-    for i, day in enumerate(days):
-        html.append(f'<div class="grid-header" style="grid-column: {i+1}; grid-row: 1;">{day}</div>')
-        
-    start_hour = 8
-    end_hour = 20
-    slots_per_hour = 4
-    total_slots = (end_hour - start_hour) * slots_per_hour
-    
-    # Render Grid Lines & Labels
-    for i in range(total_slots + 1):
-        row = i + 2
-        
-        line_class = "grid-line"
-        if i % 4 == 0: line_class += " grid-line-major"
-        html.append(f'<div class="{line_class}" style="grid-row: {row};"></div>')
-
-        if i % 2 == 0:
-            time_val = start_hour + (i / 4)
-            hour = int(time_val)
-            minute = int((time_val % 1) * 60)
-            time_str = f"{hour:02}:{minute:02}"
-            
-            label_class = "time-label"
-            if i % 4 != 0: label_class += " time-label-minor"
-            
-            html.append(f'<div class="{label_class}" style="grid-row: {row};">{time_str}</div>')
+    html = []
             
     # Events
     for e in events:
-        day_idx = DAYS_OF_WEEK.index(e['day']) + 2
+        duration = e['duration']
+        etype = e['type']
         
-        start_row = int((e['start'] - 8) * 4) + 2
-        span = int(e['duration'] * 4)
-        end_row = start_row + span
+        # Snap to 15-min slots; 2px less height leaves the 1px top/bottom margin
+        top = int((e['start'] - 8) * 4) * SLOT_PX
+        height = max(int(duration * 4), 1) * SLOT_PX - 2
         
         if e['is_gap']:
-            content = f'<div class="break-duration">{int(e["duration"])}h {int((e["duration"]%1)*60)}m Gap</div>'
-            if e.get("type") == "Mutual":
-                 content = f'<div class="break-duration">⚡ MUTUAL: {int(e["duration"])}h {int((e["duration"]%1)*60)}m</div>'
+            tpl = MUTUAL_CONTENT_TPL if etype == "Mutual" else GAP_CONTENT_TPL
+            content = tpl % format_duration(duration)
         else:
-            content = f"""
-<div class="event-title">{e['subject']}</div>
-<div class="event-meta">{e['location']}</div>
-<div class="event-meta">{e.get('type', 'Class')}</div>"""
+            # Subject/room come straight from S3 and the grid runs in a scripted iframe
+            content = CLASS_CONTENT_TPL % (escape(str(e['subject'])), escape(str(e['location'])), etype)
             
-        html.append(f"""<div class="event-card event-{e.get('type', 'Class')}" style="grid-column: {day_idx}; grid-row: {start_row} / {end_row};">{content}</div>""")
+        html.append(EVENT_CARD_TPL % (etype, DAY_TO_COL[e['day']], top, height, content))
         
-    html.append('</div>')
-    return "\n".join(html)
+    return "".join(html)
+
+def render_events_html(events):
+    """Generates the event-card HTML for a list of events."""
+    return render_events_html_cached(_events_to_key(events))
+
+def render_grid_html(events, extra_html=""):
+    """Generates the HTML structure for the grid.
+
+    extra_html is pre-rendered event-card HTML shared between grids (e.g. mutual gaps),
+    so identical cards are only formatted once per comparison.
+    """
+    return GRID_SHELL_HTML + render_events_html(events) + extra_html + GRID_SHELL_CLOSE
+
+COMPARISON_COL_TPL = '<div class="comparison-col"><h3>%s %s (%s)</h3>%s</div>'
+
+def render_comparison_html(schedules_map):
+    """Lays out every schedule's grid side by side in a single self-contained HTML payload."""
+    cols = [
+        COMPARISON_COL_TPL % ('👤' if name == 'Me' else '👥', escape(info['intake']), escape(info['group']), info['html'])
+        for name, info in schedules_map.items()
+    ]
+    return CUSTOM_CSS + '<div class="comparison-row">' + "".join(cols) + '</div>'
+
+@st.cache_data(ttl=S3_CACHE_TTL)  # Keyed on data_version; TTL only evicts old versions
+def compare_schedules(data_version, _data, selections, week_date_str):
+    """Runs the schedule -> gaps -> mutual gaps -> grid HTML pipeline for (name, intake, group) selections.
+
+    Returns (schedules_map, mutual_gaps, comparison_html). Cached on the data version and selections,
+    so reruns triggered by unrelated widgets skip straight to display.
+    """
+    schedules_map = {
+        name: {"data": process_s3_schedule(data_version, _data, intake, group, week_date_str), "intake": intake, "group": group}
+        for name, intake, group in selections
+    }
+    if not all(info["data"] for info in schedules_map.values()):
+        return schedules_map, [], ""
+
+    for info in schedules_map.values():
+        info["gaps"] = calculate_gaps(info["data"])
+    mutual_gaps = find_mutual_gaps([info["gaps"] for info in schedules_map.values()])
 
-def render_grid_html(events):
-    """Generates the HTML structure for the grid."""
-    return render_grid_html_cached(_events_to_key(events))
+    # Mutual gaps are identical in every grid, so render their cards once
+    mutual_html = render_events_html(mutual_gaps)
+    for info in schedules_map.values():
+        info["html"] = render_grid_html(info["data"], mutual_html)
+    return schedules_map, mutual_gaps, render_comparison_html(schedules_map)
 
 # --- Main App Logic ---
 
 st.title("🍱 Bila Nak Makan?")
 
-inject_custom_css()
-
-# Fetch all data first
-# Fetch all data first (Implicitly handled by cached functions now)
-# s3_data = fetch_s3_data() 
-all_intakes = get_intakes()
-available_weeks = get_available_weeks()
+# Fetch all data first (one snapshot per rerun, shared by every lookup below)
+s3 = load_s3_data()
+all_intakes = get_intakes(s3)
+available_weeks = get_available_weeks(s3)
 
 # --- State Management & Persistence ---
 
@@ -523,14 +700,14 @@ with cols[0]:
     
     filtered_my_intakes = all_intakes
     if my_filter:
-        filtered_my_intakes = [i for i in all_intakes if my_filter.upper() in i.upper()]
+        filtered_my_intakes = filter_intakes(s3, my_filter)
         
     my_ix = 0
     if default_my_intake in filtered_my_intakes:
         my_ix = filtered_my_intakes.index(default_my_intake)
         
     my_intake = st.selectbox("Select My Intake", filtered_my_intakes, index=my_ix, key="my_intake_code")
-    my_groups = get_groups(my_intake)
+    my_groups = get_groups(s3, my_intake)
     
     my_g_ix = 0
     if default_my_group in my_groups:
@@ -544,14 +721,14 @@ with cols[1]:
     
     filtered_friend_intakes = all_intakes
     if friend_filter:
-        filtered_friend_intakes = [i for i in all_intakes if friend_filter.upper() in i.upper()]
+        filtered_friend_intakes = filter_intakes(s3, friend_filter)
         
     f_ix = 0
     if default_friend_intake in filtered_friend_intakes:
          f_ix = filtered_friend_intakes.index(default_friend_intake)
     
     friend_intake = st.selectbox("Select Friend 1", filtered_friend_intakes, index=f_ix, key="friend_intake_code")
-    friend_groups = get_groups(friend_intake)
+    friend_groups = get_groups(s3, friend_intake)
     
     f_g_ix = 0
     if default_friend_group in friend_groups:
@@ -569,14 +746,14 @@ if show_friend_2:
         
         filtered_friend2_intakes = all_intakes
         if friend2_filter:
-            filtered_friend2_intakes = [i for i in all_intakes if friend2_filter.upper() in i.upper()]
+            filtered_friend2_intakes = filter_intakes(s3, friend2_filter)
             
         f2_ix = 0
         if default_friend2_intake in filtered_friend2_intakes:
              f2_ix = filtered_friend2_intakes.index(default_friend2_intake)
         
         friend2_intake = st.selectbox("Select Friend 2", filtered_friend2_intakes, index=f2_ix, key="friend2_intake_code")
-        friend2_groups = get_groups(friend2_intake)
+        friend2_groups = get_groups(s3, friend2_intake)
         
         f2_g_ix = 0
         if default_friend2_group in friend2_groups:
@@ -607,33 +784,34 @@ if show_friend_2:
     is_valid = is_valid and friend2_intake and friend2_group
 
 if is_valid:
-    # Update Params
-    st.query_params["my_intake"] = my_intake
-    st.query_params["my_group"] = my_group
-    st.query_params["friend_intake"] = friend_intake
-    st.query_params["friend_group"] = friend_group
-    st.query_params["week"] = selected_week
-    
+    # Update Params (only the keys that changed, each write is a URL update in the browser)
+    url_params = {
+        "my_intake": my_intake,
+        "my_group": my_group,
+        "friend_intake": friend_intake,
+        "friend_group": friend_group,
+        "week": selected_week,
+    }
     if show_friend_2:
-        st.query_params["friend2_intake"] = friend2_intake
-        st.query_params["friend2_group"] = friend2_group
-    else:
-        # Clear friend 2 params if toggled off
-        if "friend2_intake" in st.query_params: del st.query_params["friend2_intake"]
-        if "friend2_group" in st.query_params: del st.query_params["friend2_group"]
+        url_params["friend2_intake"] = friend2_intake
+        url_params["friend2_group"] = friend2_group
     
-    # Process Schedules
-    my_schedule = process_s3_schedule(my_intake, my_group, selected_week)
-    friend_schedule = process_s3_schedule(friend_intake, friend_group, selected_week)
+    current_params = st.query_params.to_dict()
+    changed_params = {k: v for k, v in url_params.items() if current_params.get(k) != v}
+    if changed_params:
+        st.query_params.update(changed_params)
     
-    schedules_map = {
-        "Me": {"data": my_schedule, "intake": my_intake, "group": my_group},
-        "Friend 1": {"data": friend_schedule, "intake": friend_intake, "group": friend_group}
-    }
+    if not show_friend_2:
+        # Clear friend 2 params if toggled off
+        for k in ("friend2_intake", "friend2_group"):
+            st.query_params.pop(k, None)
     
+    # Process Schedules
+    selections = [("Me", my_intake, my_group), ("Friend 1", friend_intake, friend_group)]
     if show_friend_2:
-        f2_schedule = process_s3_schedule(friend2_intake, friend2_group, selected_week)
-        schedules_map["Friend 2"] = {"data": f2_schedule, "intake": friend2_intake, "group": friend2_group}
+        selections.append(("Friend 2", friend2_intake, friend2_group))
+    
+    schedules_map, mutual_gaps, comparison_html = compare_schedules(*s3, tuple(selections), selected_week)
 
     # Check for empty schedules
     all_found = True
@@ -643,41 +821,28 @@ if is_valid:
             all_found = False
             
     if all_found:
-        # 1. Calc Gaps
-        all_gap_lists = []
-        for name, info in schedules_map.items():
-            gaps = calculate_gaps(info["data"])
-            all_gap_lists.append(gaps)
-            info["gaps"] = gaps # Store for reference
-        
-        # 2. Find Mutual (N-way)
-        mutual_gaps = find_mutual_gaps(all_gap_lists)
-        
+        # 1. Gaps & Mutual (N-way) come precomputed from compare_schedules
         if mutual_gaps:
              st.success(f"Found {len(mutual_gaps)} mutual breaks across {len(schedules_map)} schedules! 🍱")
         else:
              st.info("No mutual breaks found unfortunately.")
         
-        # 3. Combine & Display
-        cols_display = st.columns(len(schedules_map))
-        
-        idx = 0
-        for name, info in schedules_map.items():
-            display_events = info["data"] + mutual_gaps
-            with cols_display[idx]:
-                st.subheader(f"{'👤' if name=='Me' else '👥'} {info['intake']} ({info['group']})")
-                st.markdown(render_grid_html(display_events), unsafe_allow_html=True)
-            idx += 1
+        # 2. Display every grid side by side in one payload, handed to the browser verbatim
+        # (st.iframe with a raw HTML string needs streamlit>=1.65, pinned in requirements.txt)
+        # Sized to its content, so grids that wrap onto extra rows are shown in full
+        st.iframe(comparison_html, height="content")
             
-        # 4. Download Image Feature
+        # 3. Download Image Feature
         st.write("---")
         if st.checkbox("Show Export Options"):
             with st.spinner("Generating image..."):
-                img_buf = generate_schedule_image(schedules_map, mutual_gaps)
-                st.image(img_buf, caption="Preview", width=800)
+                # Preview at screen resolution; the full-resolution PNG is only rendered on click
+                # (callable download data needs streamlit>=1.65, pinned in requirements.txt)
+                preview_buf = generate_schedule_image(schedules_map, mutual_gaps, dpi=PREVIEW_DPI)
+                st.image(preview_buf, caption="Preview", width=800)
                 st.download_button(
                     label="📷 Download Comparison Image",
-                    data=img_buf,
+                    data=lambda: generate_schedule_image(schedules_map, mutual_gaps).getvalue(),
                     file_name="makan_schedule.png",
                     mime="image/png"
                 )